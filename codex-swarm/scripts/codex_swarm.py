@@ -1,32 +1,171 @@
 #!/usr/bin/env python3
+import asyncio
 import json
 import os
+import queue
+import re
 import shlex
 import shutil
 import subprocess
 import sys
 import threading
 import uuid
-from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Shared argv prefix; only the task text differs per job.
+CODEX_CMD_PREFIX = (
+    "codex",
+    "exec",
+    "--model",
+    "gpt-5.2-codex",
+    "--full-auto",
+    "--skip-git-repo-check",
+)
+
+
+# Log lines are drained by a single writer thread so a slow stderr pipe
+# never blocks the event loop; before the writer starts, eprint writes
+# directly.
+_LOG_QUEUE = queue.SimpleQueue()
+_LOG_DONE = object()
+_log_writer = None
+
+
+def _drain_logs():
+    while True:
+        line = _LOG_QUEUE.get()
+        if line is _LOG_DONE:
+            break
+        print(line, file=sys.stderr, flush=True)
+
+
+def start_log_writer():
+    global _log_writer
+    _log_writer = threading.Thread(target=_drain_logs, name="log-writer")
+    _log_writer.start()
+
+
+def stop_log_writer():
+    global _log_writer
+    if _log_writer is not None:
+        _LOG_QUEUE.put(_LOG_DONE)
+        _log_writer.join()
+        _log_writer = None
+
 
 def eprint(*args):
-    print(*args, file=sys.stderr, flush=True)
+    if _log_writer is not None:
+        _LOG_QUEUE.put(" ".join(str(arg) for arg in args))
+    else:
+        print(*args, file=sys.stderr, flush=True)
 
 
 def fail(message, code=2):
     eprint(f"error: {message}")
+    stop_log_writer()
     sys.exit(code)
 
 
 def load_input():
+    """
+    Return (jobs, max_parallel) where jobs is an iterable of job objects
+    and max_parallel is None when the manifest did not set it.
+
+    With ijson installed the manifest is tokenized incrementally from
+    stdin, so job objects are yielded as they finish parsing instead of
+    buffering the whole document into one dict tree. Without ijson the
+    original buffered json.load path is used.
+    """
     if sys.stdin.isatty():
         fail("no JSON provided on stdin")
+    if ijson is None:
+        raw = sys.stdin.buffer.read()
+        try:
+            data = orjson.loads(raw) if orjson is not None else json.loads(raw)
+        except Exception as exc:
+            fail(f"invalid JSON on stdin ({exc})")
+        return validate_jobs(data)
+    return stream_input()
+
+
+def stream_input():
+    events = ijson.parse(sys.stdin.buffer)
+    max_parallel = None
+    saw_jobs = False
+    first = True
     try:
-        return json.load(sys.stdin)
-    except Exception as exc:
+        for prefix, event, value in events:
+            if first:
+                if event != "start_map":
+                    fail("top-level JSON must be an object")
+                first = False
+                continue
+            if prefix == "":
+                # map_key/end_map bookkeeping of the top-level object.
+                continue
+            if prefix == "max_parallel":
+                if not isinstance(value, int) or value < 1:
+                    fail("'max_parallel' must be a positive integer")
+                max_parallel = value
+            elif prefix == "jobs":
+                if event != "start_array":
+                    fail("'jobs' must be a non-empty array")
+                saw_jobs = True
+                break
+    except ijson.JSONError as exc:
         fail(f"invalid JSON on stdin ({exc})")
+    if not saw_jobs:
+        fail("'jobs' must be a non-empty array")
+    # Note: stdin is not seekable, so a 'max_parallel' key written after
+    # the 'jobs' array cannot be applied; stream_jobs warns if one turns
+    # up once the array has been consumed.
+    return stream_jobs(events), max_parallel
+
+
+def stream_jobs(events):
+    builder = None
+    count = 0
+    try:
+        for prefix, event, value in events:
+            if prefix == "jobs" and event == "end_array":
+                break
+            if prefix == "jobs.item" and event == "start_map":
+                builder = ijson.ObjectBuilder()
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == "jobs.item" and event == "end_map":
+                    count += 1
+                    yield builder.value
+                    builder = None
+            elif prefix == "jobs.item":
+                # Non-object array item; let validate_job report it.
+                count += 1
+                yield value
+        # Trailing top-level keys only parse after every job has been
+        # yielded; a late max_parallel cannot cap jobs already running,
+        # so the best we can do is say so.
+        for prefix, event, value in events:
+            if prefix == "max_parallel":
+                eprint(
+                    "warning: 'max_parallel' found after 'jobs' cannot be"
+                    " applied to jobs already streaming; place it before"
+                    " the array"
+                )
+    except ijson.JSONError as exc:
+        fail(f"invalid JSON on stdin ({exc})")
+    if count == 0:
+        fail("'jobs' must be a non-empty array")
 
 
 def validate_jobs(data):
@@ -36,9 +175,7 @@ def validate_jobs(data):
     if not isinstance(jobs, list) or not jobs:
         fail("'jobs' must be a non-empty array")
     max_parallel = data.get("max_parallel")
-    if max_parallel is None:
-        max_parallel = min(4, len(jobs))
-    elif not isinstance(max_parallel, int) or max_parallel < 1:
+    if max_parallel is not None and (not isinstance(max_parallel, int) or max_parallel < 1):
         fail("'max_parallel' must be a positive integer")
     return jobs, max_parallel
 
@@ -55,28 +192,42 @@ def validate_job(job):
     return dir_raw.strip(), task
 
 
+# One pattern covers all unsafe dir shapes: '~' or '/' prefixes, a bare
+# '.' / './', and a '..' segment anywhere in the path.
+_BAD_DIR_RE = re.compile(r"^(?:~|/|\.(?:/)?$)|(?:^|/)\.\.(?:/|$)")
+
+
 def resolve_dir(dir_raw, cwd):
-    if dir_raw.startswith("~") or os.path.isabs(dir_raw):
-        fail(f"dir '{dir_raw}' must be a relative subdirectory of cwd")
-    if dir_raw in (".", "./"):
-        fail("dir cannot be current directory")
-    parts = Path(dir_raw).parts
-    if any(part == ".." for part in parts):
-        fail(f"dir '{dir_raw}' must not contain '..'")
-    target = (cwd / dir_raw).resolve()
-    try:
-        target.relative_to(cwd)
-    except ValueError:
+    """Resolve dir_raw against cwd, which must already be a realpath string."""
+    if _BAD_DIR_RE.search(dir_raw):
+        fail(f"dir '{dir_raw}' must be a relative subdirectory of cwd without '~', '.' or '..'")
+    # '..' segments are rejected above, so the lexical join catches plain
+    # escapes; the realpath below also catches symlinks pointing outside
+    # cwd. Callers memoize per distinct dir, so each is walked once.
+    # join(cwd, "") keeps the prefix a single slash when cwd is the root.
+    boundary = os.path.join(cwd, "")
+    target = os.path.normpath(os.path.join(cwd, dir_raw))
+    if target == cwd:
+        fail("dir cannot resolve to cwd")
+    if not target.startswith(boundary):
         fail(f"dir '{dir_raw}' resolves outside cwd")
+    target = os.path.realpath(target)
     if target == cwd:
         fail("dir cannot resolve to cwd")
-    if not target.is_dir():
+    if not target.startswith(boundary):
+        fail(f"dir '{dir_raw}' resolves outside cwd")
+    if not os.path.isdir(target):
         fail(f"dir '{dir_raw}' does not exist or is not a directory")
     return target
 
 
-def log_command(cmd):
-    return " ".join(shlex.quote(part) for part in cmd)
+# Quoted once; per-job command logging only has to quote the task.
+_CMD_PREFIX_QUOTED = " ".join(shlex.quote(part) for part in CODEX_CMD_PREFIX)
+
+
+def use_quiet_logging() -> bool:
+    val = os.environ.get("CODEX_SWARM_QUIET", "").strip().lower()
+    return val in ("1", "true", "yes")
 
 
 def make_run_codex_home() -> Path:
@@ -87,63 +238,133 @@ def make_run_codex_home() -> Path:
       ├─ job-2-<uuid8>/
       ...
     """
-    root = Path.home() / ".codex-swarm"
-    root.mkdir(parents=True, exist_ok=True)
+    base = os.path.join(os.path.expanduser("~/.codex-swarm"), f"run-{uuid.uuid4().hex}")
+    # One makedirs covers both the root and the run dir; the UUID name
+    # cannot collide, so no exist_ok stat probing is needed.
+    os.makedirs(base)
+    return Path(base)
 
-    base = root / f"run-{uuid.uuid4().hex}"
-    base.mkdir(parents=True, exist_ok=False)
-    return base
 
+def use_cpu_pinning() -> bool:
+    val = os.environ.get("CODEX_SWARM_PIN_CPUS", "").strip().lower()
+    return val in ("1", "true", "yes")
 
 
+def make_cpu_sets(max_parallel):
+    """
+    Partition the CPUs available to this process into max_parallel
+    disjoint sets, one per concurrency slot. Returns None when the
+    platform lacks sched_getaffinity or there are fewer CPUs than slots.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < max_parallel:
+        return None
+    sets = [set() for _ in range(max_parallel)]
+    for i, cpu in enumerate(cpus):
+        sets[i % max_parallel].add(cpu)
+    return sets
+
 
 def use_codex_home_passthrough() -> bool:
     val = os.environ.get("CODEX_HOME_PASSTHROUGH", "").strip().lower()
     if val == "":
         return True
     return val in ("1", "true", "yes")
-def run_job(index, total, target, task, lock, base_codex_home: Path | None, codex_home_env: str):
-    # Each job gets its own Codex home to avoid session lock contention.
-    job_codex_home = None
-    if base_codex_home is not None:
-        job_codex_home = base_codex_home / f"job-{index}-{uuid.uuid4().hex[:8]}"
-        job_codex_home.mkdir(parents=True, exist_ok=True)
-
-    cmd = [
-        "codex",
-        "exec",
-        "--model",
-        "gpt-5.2-codex",
-        "--full-auto",
-		"--skip-git-repo-check",
-        task,
-    ]
-
-    env = os.environ.copy()
-    if job_codex_home is not None:
-        env[codex_home_env] = str(job_codex_home)
-
-    with lock:
-        eprint(f"[job {index}/{total}] dir={target}")
-        eprint(f"[job {index}/{total}] cmd={log_command(cmd)}")
-        if job_codex_home is None:
-            eprint(f"[job {index}/{total}] {codex_home_env}=<passthrough>")
-        else:
-            eprint(f"[job {index}/{total}] {codex_home_env}={job_codex_home}")
-
-    proc = subprocess.run(cmd, cwd=str(target), env=env)
-    rc = proc.returncode
-
-    with lock:
-        eprint(f"[job {index}/{total}] exit={rc}")
-
-    return rc
+
+
+async def run_job(index, target, task, sem, base_env, job_codex_home: Path | None, codex_home_env: str, cpu_set=None, quiet=False):
+    async with sem:
+        cmd = [*CODEX_CMD_PREFIX, task]
+
+        # env=None lets the child inherit directly with no per-job dict build.
+        env = None
+        if job_codex_home is not None:
+            env = {**base_env, codex_home_env: str(job_codex_home)}
+
+        prefix = f"[job {index}]"
+        if not quiet:
+            eprint(f"{prefix} dir={target}")
+            eprint(f"{prefix} cmd={_CMD_PREFIX_QUOTED} {shlex.quote(task)}")
+            if job_codex_home is None:
+                eprint(f"{prefix} {codex_home_env}=<passthrough>")
+            else:
+                eprint(f"{prefix} {codex_home_env}={job_codex_home}")
+
+        # close_fds=False skips the fd-table sweep in the forked child;
+        # the script opens no inheritable fds beyond the standard streams.
+        # Pinning runs sched_setaffinity between fork and exec and is
+        # opt-in via CODEX_SWARM_PIN_CPUS.
+        preexec = None
+        if cpu_set is not None:
+            if not quiet:
+                eprint(f"{prefix} cpus={sorted(cpu_set)}")
+            preexec = lambda: os.sched_setaffinity(0, cpu_set)
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, cwd=str(target), env=env, close_fds=False, preexec_fn=preexec
+        )
+        rc = await proc.wait()
+
+        eprint(f"{prefix} exit={rc}")
+
+        return rc
+
+
+async def _amain(jobs, cwd, max_parallel, base_codex_home, codex_home_env):
+    sem = asyncio.Semaphore(max_parallel)
+    # Snapshot os.environ once; per-job envs extend this plain dict instead
+    # of walking the environ proxy on every call.
+    base_env = None if base_codex_home is None else os.environ.copy()
+    cpu_sets = make_cpu_sets(max_parallel) if use_cpu_pinning() else None
+    quiet = use_quiet_logging()
+    loop = asyncio.get_running_loop()
+    jobs_iter = iter(jobs)
+    end = object()
+    # Manifests often point several tasks at the same dir; resolve each
+    # distinct value once.
+    dir_cache = {}
+    tasks = []
+    idx = 0
+    while True:
+        # next() blocks on stdin in streaming mode; run it off-loop so
+        # already-submitted jobs keep making progress meanwhile.
+        job = await loop.run_in_executor(None, next, jobs_iter, end)
+        if job is end:
+            break
+        idx += 1
+        dir_raw, task = validate_job(job)
+        target = dir_cache.get(dir_raw)
+        if target is None:
+            target = resolve_dir(dir_raw, cwd)
+            dir_cache[dir_raw] = target
+        # Each job gets its own Codex home to avoid session lock contention.
+        # Created here, serially: the parent run dir already exists and the
+        # name is unique, so each one is a single plain mkdir.
+        job_home = None
+        if base_codex_home is not None:
+            job_home = base_codex_home / f"job-{idx}-{uuid.uuid4().bytes[:4].hex()}"
+            job_home.mkdir()
+        cpu_set = cpu_sets[(idx - 1) % max_parallel] if cpu_sets else None
+        tasks.append(
+            asyncio.create_task(
+                run_job(idx, target, task, sem, base_env, job_home, codex_home_env, cpu_set, quiet)
+            )
+        )
+    # Consume completions in finish order; jobs were already started by
+    # create_task above, so late-arriving manifest entries overlap the
+    # waits on earlier jobs and no ordered result list is materialized.
+    overall_rc = 0
+    for fut in asyncio.as_completed(tasks):
+        if await fut != 0:
+            overall_rc = 1
+    return overall_rc
 
 
 def main():
-    data = load_input()
-    jobs, max_parallel = validate_jobs(data)
-    cwd = Path.cwd().resolve()
+    jobs, max_parallel = load_input()
+    # Realpath of cwd computed once; resolve_dir joins against it per job.
+    cwd = os.path.realpath(os.getcwd())
 
     # Env var name can vary by environment; default to CODEX_HOME.
     # Override via: CODEX_HOME_ENV=YOUR_VAR_NAME
@@ -152,43 +373,50 @@ def main():
     passthrough = use_codex_home_passthrough()
     base_codex_home = None if passthrough else make_run_codex_home()
 
-    eprint(f"[codex-swarm] cwd={cwd}")
-    eprint(f"[codex-swarm] jobs={len(jobs)} max_parallel={max_parallel}")
+    # Pre-flight config lines are collected and emitted as one write.
+    header = [f"[codex-swarm] cwd={cwd}"]
     if base_codex_home is None:
-        eprint(f"[codex-swarm] base_codex_home=<passthrough>")
+        header.append("[codex-swarm] base_codex_home=<passthrough>")
     else:
-        eprint(f"[codex-swarm] base_codex_home={base_codex_home}")
-    eprint(f"[codex-swarm] codex_home_env={codex_home_env}")
+        header.append(f"[codex-swarm] base_codex_home={base_codex_home}")
+    header.append(f"[codex-swarm] codex_home_env={codex_home_env}")
 
-    resolved = []
-    for idx, job in enumerate(jobs, start=1):
-        dir_raw, task = validate_job(job)
-        target = resolve_dir(dir_raw, cwd)
-        resolved.append((idx, target, task))
-
-    lock = threading.Lock()
-    overall_rc = 0
+    if max_parallel is None:
+        # Streaming mode cannot know the job count up front.
+        max_parallel = min(4, len(jobs)) if isinstance(jobs, list) else 4
+    job_count = len(jobs) if isinstance(jobs, list) else "<stream>"
+    header.append(f"[codex-swarm] jobs={job_count} max_parallel={max_parallel}")
+    eprint("\n".join(header))
 
+    start_log_writer()
     try:
-        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
-            futures = [
-                executor.submit(run_job, idx, len(resolved), target, task, lock, base_codex_home, codex_home_env)
-                for idx, target, task in resolved
-            ]
-            for future in as_completed(futures):
-                rc = future.result()
-                if rc != 0:
-                    overall_rc = 1
+        overall_rc = asyncio.run(_amain(jobs, cwd, max_parallel, base_codex_home, codex_home_env))
     finally:
-        # Always cleanup when we created a run home
+        # Always cleanup when we created a run home. Rename first (atomic,
+        # one syscall), then hand the recursive unlink to a detached
+        # rm -rf in its own session so it survives interpreter exit and
+        # the process never waits on it. Falls back to a synchronous
+        # rmtree if the detach fails.
         if base_codex_home is not None:
-            shutil.rmtree(base_codex_home, ignore_errors=True)
-            with lock:
-                eprint(f"[codex-swarm] cleaned up {base_codex_home}")
+            trash = base_codex_home.with_name(f"{base_codex_home.name}.trash")
+            try:
+                base_codex_home.rename(trash)
+            except OSError:
+                trash = base_codex_home
+            try:
+                subprocess.Popen(
+                    ["rm", "-rf", str(trash)],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    start_new_session=True,
+                )
+            except OSError:
+                shutil.rmtree(trash, ignore_errors=True)
+            eprint(f"[codex-swarm] cleaning up {base_codex_home}")
+        stop_log_writer()
 
     sys.exit(overall_rc)
 
 
 if __name__ == "__main__":
     main()
-